@@ -1,10 +1,14 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
 import plotly.express as px
+import plotly.graph_objects as go
 from autogen_agentchat.agents import AssistantAgent 
 from autogen_agentchat.conditions import HandoffTermination, TextMentionTermination
 from autogen_agentchat.messages import HandoffMessage
 from autogen_agentchat.teams import Swarm 
+from autogen_core.models import SystemMessage, UserMessage
 from autogen_ext.models.openai import AzureOpenAIChatCompletionClient
 import os
 from dotenv import load_dotenv
@@ -12,67 +16,305 @@ import asyncio
 from logging_config import get_logger
 from dataclasses import dataclass
 from typing import Optional, Literal, List
-from pydantic import BaseModel, Field
+import msgspec
+import orjson
+try:
+    import uvloop
+except ImportError:  # uvloop does not support Windows
+    uvloop = None
 import re
+import io
+import ast
+import json
 import os
+import time
+import hashlib
+import threading
+import builtins
 from dotenv import load_dotenv
 
 logger = get_logger(__name__)
+
 # Load environment variables
 load_dotenv()
 
-# Initialize the model client
+@st.cache_resource
+def get_model_client():
+    """Initialize the model client once per process so its connection pool stays warm"""
+    return AzureOpenAIChatCompletionClient(
+        azure_deployment=st.secrets["AZURE_OPENAI_DEPLOYMENT"] or "",
+        azure_endpoint=st.secrets["AZURE_OPENAI_ENDPOINT"] or "",
+        model="gpt-4o-2024-05-13",
+        api_version="2024-02-01",
+        api_key=st.secrets["AZURE_OPENAI_API_KEY"] or "",
+    )
 
-model_client = AzureOpenAIChatCompletionClient(
-    azure_deployment=st.secrets["AZURE_OPENAI_DEPLOYMENT"] or "",
-    azure_endpoint=st.secrets["AZURE_OPENAI_ENDPOINT"] or "",
-    model="gpt-4o-2024-05-13",
-    api_version="2024-02-01",
-    api_key=st.secrets["AZURE_OPENAI_API_KEY"] or "",
-)
+class CodeBlock(msgspec.Struct, frozen=True):
+    """The generated code block with its type and explanation"""
+    # The Python code to be executed
+    code: str
+    # Type of code: visualization for plots, analysis for other operations
+    code_type: Literal['visualization', 'analysis']
+    # explanation of the trend/pattern/insight/summary of the data based on the data and the code
+    observation: Optional[str] = None
 
-class CodeResponse(BaseModel):
+class CodeResponse(msgspec.Struct, frozen=True):
     """Structured response for code generation"""
-    class CodeBlock(BaseModel):
-        code: str = Field(..., description="The Python code to be executed")
-        code_type: Literal['visualization', 'analysis'] = Field(..., 
-            description="Type of code: visualization for plots, analysis for other operations")
-        observation: Optional[str] = Field(None, 
-            description="explanation of the trend/pattern/insight/summary of the data based on the data and the code")
-
-    result: CodeBlock = Field(..., 
-        description="The generated code block with its type and explanation")
-
-# Initialize Assistant Agent with visualization capabilities and structured output
-Assistant = AssistantAgent(
-    "Assistant",
-    model_client=model_client,
-    tools=[],
-    description="Agent to analyze CSV data and create visualizations",
-    system_message=f"""You are a data visualization expert proficient in using Plotly Express. 
+    result: CodeBlock
+
+class BatchCodeResponse(msgspec.Struct, frozen=True):
+    """Structured response for several queries answered in one call"""
+    # One generated code block per query, in query order
+    results: List[CodeBlock]
+
+# Typed decoders build the structs straight from JSON; unknown fields are ignored
+_code_response_decoder = msgspec.json.Decoder(CodeResponse)
+_batch_response_decoder = msgspec.json.Decoder(BatchCodeResponse)
+
+SYSTEM_MESSAGE_TEMPLATE = """You are a data visualization expert proficient in using Plotly Express. 
     You have access to the already loaded dataframe 'df'. Your task is to generate Python code that creates insightful visualizations based on the provided dataset. 
     Ensure that your response is a JSON object adhering to the following Pydantic model:
             <Pydantic Model>
-            class CodeResponse:
-                result: CodeBlock
-                    code: str  # The Python code to execute
-                    code_type: Literal['visualization', 'analysis']  # Type of code
-                    observation: Optional[str]  # trend/pattern/insight/summary of the data
+{schema}
             </Pydantic Model>
             - Use px.line, px.scatter, px.bar, or other appropriate plotly express charts, and px.box for distribution.
-            - Utilize appropriate Plotly Express functions such as px.line, px.scatter, px.bar, etc., to create meaningful visualizations.
             - The generated code should be executable and free from errors, Use pd.concat() to combine multiple dataframes.
             - Provide a brief explanation of observed trend/pattern/insight/summary of the data.
     """
+
+SYSTEM_MESSAGE = SYSTEM_MESSAGE_TEMPLATE.format(schema="""            class CodeResponse:
+                result: CodeBlock
+                    code: str  # The Python code to execute
+                    code_type: Literal['visualization', 'analysis']  # Type of code
+                    observation: Optional[str]  # trend/pattern/insight/summary of the data""")
+
+# Batch tasks answer several queries at once, so the model must return a list of blocks
+BATCH_SYSTEM_MESSAGE = SYSTEM_MESSAGE_TEMPLATE.format(schema="""            class BatchCodeResponse:
+                results: List[CodeBlock]  # One entry per query, in query order
+                    code: str  # The Python code to execute
+                    code_type: Literal['visualization', 'analysis']  # Type of code
+                    observation: Optional[str]  # trend/pattern/insight/summary of the data""")
+
+def create_assistant(model_client, system_message=SYSTEM_MESSAGE):
+    """Initialize Assistant Agent with visualization capabilities and structured output.
+
+    A fresh agent is built per task: agents keep their conversation history,
+    so sharing one between concurrent tasks would mix their messages.
+    """
+    return AssistantAgent(
+        "Assistant",
+        model_client=model_client,
+        tools=[],
+        description="Agent to analyze CSV data and create visualizations",
+        system_message=system_message
+    )
+
+@st.cache_resource
+def get_event_loop():
+    """Start one long-lived event loop in a background thread for all agent calls"""
+    loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="llm-event-loop", daemon=True).start()
+    return loop
+
+def run_async(coro):
+    """Run a coroutine on the shared event loop and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+async def gather_all(coros):
+    """Await several coroutines concurrently, preserving their order"""
+    return await asyncio.gather(*coros)
+
+async def next_chunk(agen):
+    """Await the next item of an async generator as a plain coroutine"""
+    return await agen.__anext__()
+
+def iterate_async(agen):
+    """Iterate an async generator from the script thread via the shared event loop"""
+    try:
+        while True:
+            try:
+                yield run_async(next_chunk(agen))
+            except StopAsyncIteration:
+                return
+    finally:
+        run_async(agen.aclose())
+
+# Seconds a cached LLM response stays valid for a given task
+LLM_CACHE_TTL = 3600
+
+def get_llm_cache():
+    """Per-session cache of raw LLM responses, keyed on task hash"""
+    if "llm_cache" not in st.session_state:
+        st.session_state["llm_cache"] = {}
+    return st.session_state["llm_cache"]
+
+def get_batch_task_hash(queries, data_profile):
+    """Hash a batch of queries together with the column profile sent alongside them"""
+    return get_task_hash("\n".join(queries), data_profile)
+
+def get_task_hash(query, data_profile):
+    """Hash the normalized query together with the column profile sent alongside it.
+
+    The profile carries the schema plus per-file sample values and ranges, so
+    files that share a schema but differ in content get separate entries.
+    """
+    key = query.strip().lower() + "|" + data_profile
+    return hashlib.blake2b(key.encode()).hexdigest()
+
+# Process-wide data caches hold O(rows) entries (dataframes, figure dicts), so bound them
+DATA_CACHE_TTL = 3600
+CSV_CACHE_MAX_ENTRIES = 8
+FIGURE_CACHE_MAX_ENTRIES = 32
+
+# Upper bound on queries answered per LLM call; larger batches grow latency
+MAX_BATCH_SIZE = 4
+
+def lookup_cache(llm_cache, task_hash):
+    """Return the cached response for a task if it has not expired"""
+    cached = llm_cache.get(task_hash)
+    if cached and time.monotonic() - cached[0] < LLM_CACHE_TTL:
+        logger.debug(f"LLM cache hit for task {task_hash[:12]}")
+        return cached[1]
+    return None
+
+async def run_task(task, task_hash, llm_cache, model_client, decoder, system_message=SYSTEM_MESSAGE):
+    """Run a task through the agent and decode the reply, reusing a cached response when available.
+
+    Only replies that decode are cached, so a bad answer is retried on the next
+    click; decoding errors propagate to the caller.
+    """
+    response_content = lookup_cache(llm_cache, task_hash)
+    if response_content is not None:
+        return decode_response(decoder, response_content)
+
+    logger.debug(f"Running task: {task}")
+    task_result = await create_assistant(model_client, system_message).run(task=task)
+    
+    response_content = None
+    for msg in reversed(task_result.messages):
+        content = getattr(msg, 'content', None)
+        if isinstance(content, str):
+            response_content = content
+            break
+    if not response_content:
+        return None
+    structured_response = decode_response(decoder, response_content)
+    llm_cache[task_hash] = (time.monotonic(), response_content)
+    return structured_response
+
+async def stream_task(task, model_client):
+    """Stream the model's reply to a task chunk by chunk.
+
+    Talks to the model client directly since AssistantAgent.run only returns
+    once the whole reply has been generated.
+    """
+    messages = [SystemMessage(content=SYSTEM_MESSAGE), UserMessage(content=task, source="user")]
+    async for chunk in model_client.create_stream(messages):
+        # The stream ends with the full CreateResult, already seen as text chunks
+        if isinstance(chunk, str):
+            yield chunk
+
+# Opening of each JSON string field read while a response streams in
+_FIELD_RES = {field: re.compile(rf'"{field}"\s*:\s*"') for field in ('code', 'observation')}
+# One complete token inside a JSON string: a run of plain characters, an escape
+# (surrogate pairs kept together) or the closing quote. A lone high surrogate is
+# only taken once the text after it shows no low-surrogate escape is coming.
+_STRING_TOKEN_RE = re.compile(
+    r'[^"\\]+'
+    r'|\\u[dD][89abAB][0-9a-fA-F]{2}\\u[dD][c-fC-F][0-9a-fA-F]{2}'
+    r'|\\u[dD][89abAB][0-9a-fA-F]{2}(?=[^\\]|\\[^u]|\\u(?![dD][c-fC-F])[0-9a-fA-F]{4})'
+    r'|\\u(?![dD][89abAB])[0-9a-fA-F]{4}'
+    r'|\\["\\/bfnrt]'
+    r'|"'
 )
 
+class StreamedStringField:
+    """Incrementally decodes one JSON string field from a response that is still arriving.
+
+    Only text past the last consumed offset is decoded on each feed, so the
+    total work stays linear in the length of the stream.
+    """
+
+    def __init__(self, field):
+        self.pattern = _FIELD_RES[field]
+        self.value = ""
+        # Offset of the next undecoded character, once the field has been found
+        self.pos = None
+        # Offset just past the closing quote, once the string is complete
+        self.end = None
+
+    def feed(self, content, search_from=0):
+        """Decode newly arrived content and return the text added to the value"""
+        if self.end is not None:
+            return ""
+        if self.pos is None:
+            match = self.pattern.search(content, search_from)
+            if match is None:
+                return ""
+            self.pos = match.end()
+        parts = []
+        while True:
+            # No match means the content ends mid-escape or nothing new arrived
+            token = _STRING_TOKEN_RE.match(content, self.pos)
+            if token is None:
+                break
+            self.pos = token.end()
+            text = token.group()
+            if text == '"':
+                self.end = self.pos
+                break
+            parts.append(json.loads(f'"{text}"') if text[0] == '\\' else text)
+        added = "".join(parts)
+        self.value += added
+        return added
+
+def strip_markdown(content):
+    """Remove markdown code fences the model sometimes wraps JSON in"""
+    if "```" in content:
+        # Extract content between triple backticks
+        content = content.split("```")[1]
+        if content.startswith("json"):
+            content = content[4:]  # Remove "json" prefix
+        content = content.strip()
+    return content
+
+def decode_response(decoder, response_content):
+    """Decode a model response, only stripping markdown when plain decoding fails"""
+    try:
+        return decoder.decode(response_content)
+    except msgspec.DecodeError:
+        return decoder.decode(strip_markdown(response_content))
+
 # Set up termination conditions
 # termination = HandoffTermination(target="user") |TextMentionTermination("TERMINATE")
-# team = Swarm([Assistant], termination_condition=termination, max_turns=20)
+# team = Swarm([create_assistant(get_model_client())], termination_condition=termination, max_turns=20)
 
-async def get_visualization_code(df, query, csv_string):
-    """Get visualization code from the agent using structured output"""
-    task = f"""Given this dataframe with columns
+# Detailed chart examples, only sent when the query mentions one of their keywords
+PLOTLY_EXAMPLES = [
+    (('correlat', 'heatmap', 'relationship'),
+     "Heatmap for correlation analysis: px.imshow(df.corr(), text_auto=True, color_continuous_scale='Viridis')"),
+    (('distribut', 'histogram', 'frequenc'),
+     "Histogram for data distribution: px.histogram(df, x='Salary', nbins=20, title='Salary Distribution')"),
+    (('hierarch', 'nested', 'treemap', 'industry'),
+     "Treemap for hierarchical data: px.treemap(df, path=['Industry', 'Job Role'], values='Salary')"),
+    (('bubble', 'size', 'weight'),
+     "Bubble chart for weighted scatter plots: px.scatter(df, x='GPA', y='Salary', size='Work Experience', color='Industry')"),
+    (('country', 'state', 'city', 'region', 'geograph', 'sunburst', 'drill'),
+     "Sunburst for multi-level categories: px.sunburst(df, path=['Country', 'State', 'City'], values='Population')"),
+]
+
+def format_examples(query):
+    """Render the chart examples whose keywords appear in the query as prompt notes"""
+    query = query.lower()
+    examples = [example for keywords, example in PLOTLY_EXAMPLES
+                if any(keyword in query for keyword in keywords)]
+    if not examples:
+        return ""
+    return "\n    - Relevant examples:" + "".join(f"\n    -- {example}" for example in examples)
+
+def build_task(df, query, data_profile):
+    """Build the structured-output task for a single query"""
+    return f"""Given this dataframe with columns
     <Columns>
     {list(df.columns)}
     </Columns>
@@ -81,10 +323,10 @@ async def get_visualization_code(df, query, csv_string):
     </Query>
     Your response should be structured as specified.
     IMPORTANT: The data is already loaded as 'df'. DO NOT include pd.read_csv().
-    First 5 rows of data: 
-    <Data>
-    {csv_string}
-    </Data>
+    Column profile (dtype, distinct count, sample values, numeric range): 
+    <Profile>
+    {data_profile}
+    </Profile>
     
     Focus on the mentioned columns in the query to derive a correlation and plot the graph using Plotly.
     Ensure the code is structured as a JSON object adhering to the following Pydantic model:
@@ -98,85 +340,272 @@ async def get_visualization_code(df, query, csv_string):
     Note:
     - Exclude fig.show() at the end of the code
     - Respond with a raw JSON object without any markdown formatting.
-    - Common visualization types:
-    -- px.bar → categorical comparisons (e.g., count of people in each major)
-    -- px.scatter → correlations (e.g., GPA vs. Salary)
-    -- px.line → trends over time (if applicable)
-    -- px.box → distributions (e.g., salary distribution by major)
-    -- px.pie → proportions (e.g., gender distribution)
-    -- px.histogram → frequency distribution (e.g., salary distribution by major)
-    -- px.area → trends over time (if applicable)
-    -- px.heatmap → correlations (e.g., GPA vs. Salary)
-    -- px.line_polar → trends over time (eg. salary distribution by gender)
-    -- px.line_geo → trends over time (eg. salary distribution by country)
-    -- px.line_mapbox → trends over time (eg. salary distribution by city)
-    -- px.line_choropleth → trends over time (eg. salary distribution by country)
-    -- px.line_mapbox → trends over time (eg. salary distribution by city)
-            1. Heatmaps for Correlation Analysis
-        Function: px.imshow(df.corr(), text_auto=True, color_continuous_scale='Viridis')
-        Use Case: Visualizing correlation matrices between numerical columns.
-        2. Histograms for Data Distribution
-        Function: px.histogram(df, x='Salary', nbins=20, title='Salary Distribution')
-        Use Case: Understanding distribution of numerical variables.
-        3. Treemaps for Hierarchical Data
-        Function: px.treemap(df, path=['Industry', 'Job Role'], values='Salary')
-        Use Case: Displaying nested categorical data like industry vs. salary.
-        4. Bubble Charts for Weighted Scatter Plots
-        Function: px.scatter(df, x='GPA', y='Salary', size='Work Experience', color='Industry')
-        Use Case: Showing relationships with an extra size dimension.
-        5. Sunburst Charts for Multi-Level Categories
-        Function: px.sunburst(df, path=['Country', 'State', 'City'], values='Population')
-        Use Case: Drill-down visualization for regional or hierarchical data
+    - Use px.bar/scatter/line/area/box/pie/histogram/imshow/treemap/sunburst as appropriate.{format_examples(query)}
     """
+
+def fallback_code_response(response_content):
+    """Treat a reply that doesn't match CodeResponse as bare code"""
+    code = response_content.strip()
+    if code.startswith("```python"):
+        code = code.replace("```python", "").replace("```", "").strip()
+    elif code.startswith("```"):
+        code = code.replace("```", "").strip()
     
-    logger.debug(f"Running task: {task}")
-    task_result = await Assistant.run(task=task)
-    
-    messages = task_result.messages
-    response_content = next((msg.content for msg in reversed(messages) 
-                           if hasattr(msg, 'content') and isinstance(msg.content, str)), 
-                           None)
-    
+    # Create a CodeResponse object with the fallback parsing
+    return CodeResponse(
+        result=CodeBlock(
+            code=code,
+            code_type='visualization' if 'fig' in code else 'analysis',
+            observation="Generated from fallback parsing"
+        )
+    )
+
+def stream_visualization_code(df, query, data_profile, llm_cache, model_client):
+    """Get visualization code for a query, rendering code and observation as they stream in"""
+    st.subheader("Generated Python Code:")
+    code_placeholder = st.empty()
+    task_hash = get_task_hash(query, data_profile)
+    response_content = lookup_cache(llm_cache, task_hash)
+    cache_hit = response_content is not None
+    streamed_observation = ""
+
+    if response_content is None:
+        received = {'content': ""}
+
+        def observation_stream():
+            code = StreamedStringField('code')
+            observation = StreamedStringField('observation')
+            content = ""
+            try:
+                for chunk in iterate_async(stream_task(build_task(df, query, data_profile), model_client)):
+                    content += chunk
+                    if observation.end is not None:
+                        continue
+                    if code.end is None:
+                        if code.feed(content):
+                            code_placeholder.code(code.value, language='python')
+                        if code.end is None:
+                            continue
+                        # Compile while the observation is still being generated
+                        try:
+                            compile_code(code.value)
+                        except Exception as e:
+                            logger.warning(f"Generated code failed to compile: {e}")
+                    # Only look past the code, so text inside the code can't match
+                    added = observation.feed(content, code.end)
+                    if added:
+                        yield added
+            finally:
+                received['content'] = content
+
+        streamed_observation = st.write_stream(observation_stream())
+        response_content = received['content']
+
+    response = None
     if response_content:
         try:
-            # Clean up the response content by removing markdown formatting
-            cleaned_content = response_content
-            if "```" in cleaned_content:
-                # Extract content between triple backticks
-                cleaned_content = cleaned_content.split("```")[1]
-                if cleaned_content.startswith("json"):
-                    cleaned_content = cleaned_content[4:]  # Remove "json" prefix
-                cleaned_content = cleaned_content.strip()
-            
-            # Parse the cleaned response into our Pydantic model
-            structured_response = CodeResponse.model_validate_json(cleaned_content)
-            logger.debug(f"Structured response: {structured_response}")
-            return structured_response
+            # Parse the response into our CodeResponse struct
+            response = decode_response(_code_response_decoder, response_content)
+            logger.debug(f"Structured response: {response}")
+            if not cache_hit:
+                # Only replies that decode are cached, so a bad answer can be retried
+                llm_cache[task_hash] = (time.monotonic(), response_content)
         except Exception as e:
             logger.error(f"Error parsing structured response: {e}")
-            # Fallback to basic parsing if structured parsing fails
-            code = response_content.strip()
-            if code.startswith("```python"):
-                code = code.replace("```python", "").replace("```", "").strip()
-            elif code.startswith("```"):
-                code = code.replace("```", "").strip()
-            
-            # Create a CodeResponse object with the fallback parsing
-            return CodeResponse(
-                result=CodeResponse.CodeBlock(
-                    code=code,
-                    code_type='visualization' if 'fig' in code else 'analysis',
-                    observation="Generated from fallback parsing"
-                )
-            )
+            # Fallback to basic parsing if structured parsing fails; never cached
+            response = fallback_code_response(response_content)
+    if response:
+        code_placeholder.code(response.result.code, language='python')
+        if response.result.observation and not streamed_observation:
+            st.write(response.result.observation)
+    return response
+
+async def get_batch_visualization_code(df, queries, data_profile, llm_cache, model_client):
+    """Get visualization code for several queries from a single agent call"""
+    numbered_queries = "\n".join(f"Query {i}: {q}" for i, q in enumerate(queries, 1))
+    task = f"""Given this dataframe with columns
+    <Columns>
+    {list(df.columns)}
+    </Columns>
+    <Queries>
+    {numbered_queries}
+    </Queries>
+    Answer every query independently, in order.
+    IMPORTANT: The data is already loaded as 'df'. DO NOT include pd.read_csv().
+    Column profile (dtype, distinct count, sample values, numeric range): 
+    <Profile>
+    {data_profile}
+    </Profile>
+    
+    Ensure the response is a JSON object with one entry per query in "results":
+    {{
+        "results": [
+            {{"code": "fig = px.histogram(df, x='Gender')", "code_type": "visualization", "observation": "..."}},
+            {{"code": "fig = px.scatter(df, x='GPA', y='Salary')", "code_type": "visualization", "observation": "..."}}
+        ]
+    }}
+    Note:
+    - Exclude fig.show() at the end of the code
+    - Respond with a raw JSON object without any markdown formatting.
+    """
+    
+    try:
+        structured_response = await run_task(
+            task, get_batch_task_hash(queries, data_profile), llm_cache, model_client,
+            _batch_response_decoder, BATCH_SYSTEM_MESSAGE)
+        logger.debug(f"Structured batch response: {structured_response}")
+        return structured_response
+    except Exception as e:
+        logger.error(f"Error parsing structured batch response: {e}")
     
     return None
 
-def extract_figure_names(code):
-    """Extracts figure variable names from the given code."""
-    # Regex to find variable names assigned to Plotly figures
-    figure_names = re.findall(r'(\w+)\s*=\s*px\.', code)
-    return figure_names
+# Top-level packages generated code may import
+ALLOWED_IMPORTS = {'pandas', 'numpy', 'plotly'}
+# Builtins generated code may not call
+BLOCKED_CALLS = {'open', 'exec', 'eval', 'compile', '__import__', 'input', 'breakpoint',
+                 'globals', 'locals', 'vars', 'getattr', 'setattr', 'delattr',
+                 'exit', 'quit', 'help'}
+
+def restricted_import(name, globals=None, locals=None, fromlist=(), level=0):
+    """Import hook for generated code that only admits the allowlisted packages"""
+    if level or name.split('.')[0] not in ALLOWED_IMPORTS:
+        raise ImportError(f"Import of '{name}' is not allowed")
+    return __import__(name, globals, locals, fromlist, level)
+
+# Builtins visible to generated code: blocked calls and private names are left out,
+# so they can't be reached through an alias either
+SAFE_BUILTINS = {name: getattr(builtins, name) for name in dir(builtins)
+                 if name not in BLOCKED_CALLS and not name.startswith('_')}
+SAFE_BUILTINS['__import__'] = restricted_import
+
+def validate_code(tree):
+    """Reject generated code that imports outside the allowlist, calls unsafe builtins or touches dunders"""
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            modules = [node.module or '']
+        else:
+            modules = []
+        for module in modules:
+            if module.split('.')[0] not in ALLOWED_IMPORTS:
+                raise ValueError(f"Import of '{module}' is not allowed")
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+                and node.func.id in BLOCKED_CALLS):
+            raise ValueError(f"Call to '{node.func.id}' is not allowed")
+        if isinstance(node, ast.Attribute) and node.attr.startswith('__'):
+            raise ValueError(f"Access to '{node.attr}' is not allowed")
+        if isinstance(node, ast.Name) and node.id.startswith('__'):
+            raise ValueError(f"Access to '{node.id}' is not allowed")
+
+def is_px_call(node):
+    """Check whether an expression is a call chain rooted at px, e.g. px.bar(...).update_layout(...)"""
+    if not isinstance(node, ast.Call):
+        return False
+    while isinstance(node, (ast.Call, ast.Attribute)):
+        node = node.func if isinstance(node, ast.Call) else node.value
+    return isinstance(node, ast.Name) and node.id == 'px'
+
+def extract_figure_names(tree):
+    """Extracts names of variables assigned Plotly Express figures from a parsed module."""
+    return [target.id for node in ast.walk(tree)
+            if isinstance(node, ast.Assign) and is_px_call(node.value)
+            for target in node.targets if isinstance(target, ast.Name)]
+
+@st.cache_resource
+def compile_code(code):
+    """Validate and compile generated code once per unique source string.
+
+    Returns the code object and the figure names it assigns, both taken from
+    a single parse of the source.
+    """
+    tree = ast.parse(code, filename="<llm>")
+    validate_code(tree)
+    return compile(tree, "<llm>", "exec"), extract_figure_names(tree)
+
+@st.cache_data(ttl=DATA_CACHE_TTL, max_entries=FIGURE_CACHE_MAX_ENTRIES)
+def render_figures(code_hash, df_hash, _code, _df):
+    """Execute generated code once per (code, data) pair and return its figures as plain dicts"""
+    code_obj, figure_names = compile_code(_code)
+    # Dedicated namespace: the code never sees this module's globals (os, st, secrets)
+    namespace = {'__builtins__': SAFE_BUILTINS, 'df': _df, 'pd': pd, 'np': np, 'px': px}
+    exec(code_obj, namespace)
+    
+    return {fig_name: namespace[fig_name].to_dict() for fig_name in figure_names
+            if isinstance(namespace.get(fig_name), go.Figure)}
+
+def execute_code_block(df, df_hash, code_block):
+    """Execute generated code against df and render the figures it creates"""
+    code = str(code_block.code)
+    code_hash = hashlib.blake2b(code.encode()).hexdigest()
+    
+    for fig_name, fig_dict in render_figures(code_hash, df_hash, code, df).items():
+        st.subheader(f"Generated Visualization: {fig_name}")
+        st.plotly_chart(go.Figure(fig_dict))
+
+def profile_df(df, k=3):
+    """Summarize each column as dtype, distinct count, sample values and numeric range"""
+    profile = {}
+    for col in df.columns:
+        series = df[col]
+        column_profile = {
+            "dtype": str(series.dtype),
+            "n_unique": int(series.nunique()),
+            "sample": series.dropna().head(k).tolist(),
+        }
+        if pd.api.types.is_numeric_dtype(series):
+            column_profile["min"] = float(series.min())
+            column_profile["max"] = float(series.max())
+        elif pd.api.types.is_datetime64_any_dtype(series):
+            column_profile["min"] = str(series.min())
+            column_profile["max"] = str(series.max())
+        profile[col] = column_profile
+    return profile
+
+def normalize_dates(df):
+    """Give date columns a datetime64 dtype.
+
+    The pyarrow engine parses ISO dates into datetime.date objects that still
+    report object dtype, so the profile would present them as strings and
+    generated string code (df['Date'].str[:7]) would fail on them.
+    """
+    for col in df.columns:
+        if df[col].dtype == object and pd.api.types.infer_dtype(df[col], skipna=True) == 'date':
+            df[col] = pd.to_datetime(df[col])
+    return df
+
+def optimize_dtypes(df):
+    """Downcast float columns to halve their memory.
+
+    Integers keep their width and text columns stay object dtype: generated
+    code does arithmetic and string handling on df that narrow integers
+    (silent overflow) or categoricals (fillna, map, select_dtypes) would break.
+    """
+    for col in df.columns:
+        if pd.api.types.is_float_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], downcast='float')
+    return df
+
+@st.cache_data(ttl=DATA_CACHE_TTL, max_entries=CSV_CACHE_MAX_ENTRIES)
+def preview_csv(file_bytes):
+    """Parse an uploaded CSV once per file into the dataframe, its prompt column profile and a content hash"""
+    try:
+        # pyarrow's multithreaded reader; columns stay NumPy-backed for optimize_dtypes
+        df = pd.read_csv(io.BytesIO(file_bytes), engine='pyarrow')
+    except (pa.ArrowInvalid, pd.errors.ParserError) as e:
+        # pyarrow rejects some valid CSVs, e.g. quoted fields spanning lines
+        logger.debug(f"pyarrow CSV parse failed, falling back to the C engine: {e}")
+        df = pd.read_csv(io.BytesIO(file_bytes))
+    else:
+        # Unlike the C engine, pyarrow infers ISO dates and datetimes as temporal types
+        df = normalize_dates(df)
+    df.columns = df.columns.str.strip()
+    # Profile the parsed values, before float32 adds noise digits to samples and ranges
+    data_profile = orjson.dumps(profile_df(df), default=str).decode()
+    df = optimize_dtypes(df)
+    df_hash = hashlib.blake2b(pd.util.hash_pandas_object(df, index=False).values.tobytes()).hexdigest()
+    return df, data_profile, df_hash
 
 def main():
     st.title("CSV Data Analysis & Visualization")
@@ -186,10 +615,7 @@ def main():
 
     if uploaded_file is not None:
         try:
-            df = pd.read_csv(uploaded_file)
-            df.columns = df.columns.str.strip()
-            df_5_rows = df.head(200)
-            csv_string = df_5_rows.to_string(index=False)
+            df, data_profile, df_hash = preview_csv(uploaded_file.getvalue())
     
             # Basic data info
             st.subheader("Dataset Overview")
@@ -211,58 +637,62 @@ def main():
                 if user_query:
                     try:
                         with st.spinner("Processing your request..."):
-                            response = asyncio.run(get_visualization_code(df, user_query, csv_string))
+                            llm_cache = get_llm_cache()
+                            response = stream_visualization_code(
+                                df, user_query, data_profile, llm_cache, get_model_client())
                             
                             if response and isinstance(response, CodeResponse):
-                                st.subheader("Generated Python Code:")
-                                st.code(response.result.code, language='python')
-                                
-                                if response.result.observation:
-                                    st.write(response.result.observation)
-                                
                                 try:
-                                    # Define local execution context
-                                    local_vars = {'df': df, 'pd': pd, 'px': px}
-                                    exec(str(response.result.code), globals(), local_vars)
-                                    
-                                    # Extract figure names
-                                    figure_names = extract_figure_names(response.result.code)
-                                    
-                                    for fig_name in figure_names:
-                                        if fig_name in local_vars:
-                                            st.subheader(f"Generated Visualization: {fig_name}")
-                                            st.plotly_chart(local_vars[fig_name])
-                                    
+                                    execute_code_block(df, df_hash, response.result)
                                 except Exception as e:
                                     st.error(f"Error executing code: {e}")
+                                    # Fetch fresh code on the next click instead of this broken one
+                                    llm_cache.pop(get_task_hash(user_query, data_profile), None)
                                     
                     except Exception as e:
                         st.error(f"Error processing request: {e}")
 
             # Automatic visualization generation
-            # st.subheader("Suggested Visualizations")
+            st.subheader("Suggested Visualizations")
             
-            # visualization_queries = [
-            #     "Create a histogram or bar chart for the most frequent categorical column",
-            #     "Create a scatter plot using the two most correlated numerical columns",
-            #     "Create a box plot showing distribution of numerical columns",
-            #     "Create a pie chart for the most important categorical column"
-            # ]
-
-            # for query in visualization_queries:
-            #     try:
-            #         with st.spinner(f"Generating visualization: {query}"):
-            #             code = asyncio.run(get_visualization_code(df, query, csv_string))
-            #             if code and code.result_type == 'visualization':  # Only process visualization code
-            #                 try:
-            #                     local_vars = {'df': df, 'px': px}
-            #                     exec(str(code), globals(), local_vars)
-            #                     if 'fig' in local_vars:
-            #                         st.plotly_chart(local_vars['fig'])
-            #                 except Exception as e:
-            #                     st.error(f"Error executing visualization code: {e}")
-            #     except Exception as e:
-            #         st.error(f"Error generating visualization: {e}")
+            visualization_queries = [
+                "Create a histogram or bar chart for the most frequent categorical column",
+                "Create a scatter plot using the two most correlated numerical columns",
+                "Create a box plot showing distribution of numerical columns",
+                "Create a pie chart for the most important categorical column"
+            ]
+
+            if st.button("Suggest Visualizations"):
+                try:
+                    with st.spinner("Generating suggested visualizations..."):
+                        # Queries are batched per request and the batches run concurrently
+                        # Resolved here: the event loop thread has no script context
+                        llm_cache = get_llm_cache()
+                        model_client = get_model_client()
+                        query_batches = [visualization_queries[i:i + MAX_BATCH_SIZE]
+                                         for i in range(0, len(visualization_queries), MAX_BATCH_SIZE)]
+                        batches = run_async(gather_all([
+                            get_batch_visualization_code(df, queries, data_profile, llm_cache, model_client)
+                            for queries in query_batches
+                        ]))
+                    if any(batch is None for batch in batches):
+                        st.error("Could not parse suggested visualizations")
+                    for queries, batch in zip(query_batches, batches):
+                        if batch is None:
+                            continue
+                        for code_block in batch.results:
+                            if code_block.code_type != 'visualization':  # Only process visualization code
+                                continue
+                            try:
+                                if code_block.observation:
+                                    st.write(code_block.observation)
+                                execute_code_block(df, df_hash, code_block)
+                            except Exception as e:
+                                st.error(f"Error executing visualization code: {e}")
+                                # Fetch fresh code for this batch on the next click
+                                llm_cache.pop(get_batch_task_hash(queries, data_profile), None)
+                except Exception as e:
+                    st.error(f"Error generating visualization: {e}")
 
         except Exception as e:
             st.error(f"An error occurred while processing the file: {e}")